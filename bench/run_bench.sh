@@ -0,0 +1,22 @@
+#!/usr/bin/env bash
+# Benchmark prompt processing (-p) and generation (-n) speed across quantizations.
+# Requires llama-bench from a llama.cpp build and the GGUF files in MODELS_DIR.
+#
+#   MODELS_DIR=models bench/run_bench.sh > bench/results-$(hostname).csv
+set -euo pipefail
+
+MODELS_DIR="${MODELS_DIR:-models}"
+QUANTS="${QUANTS:-Q5_0 Q4_K_M Q4_0 Q3_K_M IQ3_XS}"
+THREADS="${THREADS:-$(nproc)}"
+
+header=1
+for quant in $QUANTS; do
+    model="$MODELS_DIR/zephyr-7b-beta.$quant.gguf"
+    if [ ! -f "$model" ]; then
+        echo "skipping $quant: $model not found" >&2
+        continue
+    fi
+    # llama-bench prints a CSV header per run; keep only the first one
+    llama-bench -m "$model" -p 512 -n 128 -t "$THREADS" -o csv | tail -n +"$((header ? 1 : 2))"
+    header=0
+done
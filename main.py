@@ -1,172 +1,669 @@
-from fastapi import FastAPI
-from pydantic import BaseModel
-from typing import List
-from langchain.llms import LlamaCpp
-from langchain.prompts import PromptTemplate
-from langchain.chains import LLMChain
+"""RIASEC career recommendation API backed by a local Zephyr-7B GGUF model.
+
+Quantization trade-off: CPU decode is memory-bandwidth bound, so smaller weights mean
+faster tokens. Q4_K_M (default) moves ~20% fewer bytes per token than Q5_0 and uses the
+tuned K-quant AVX2/AVX-512 kernels, at a negligible quality cost. Q4_0 is the fastest
+legacy kernel; Q3_K_M and IQ3_XS are faster still but noticeably lossier, so validate
+them against a held-out set of responses before pointing MODEL_PATH at one.
+Run bench/run_bench.sh to compare the variants on the target machine.
+"""
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, Field
+from typing import AsyncIterator, List, Optional, Tuple
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from llama_cpp import Llama
 from dotenv import load_dotenv
+import asyncio
+import codecs
+import llama_cpp
+import logging
+import numpy as np
+import orjson
 import os
+import psutil
+import redis
+import threading
+import time
 load_dotenv()
 
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
+logger = logging.getLogger(__name__)
+
 # Make sure to add the model path to your environment variables or set it here directly
-MODEL_PATH = os.environ.get("MODEL_PATH", "models/zephyr-7b-beta.Q5_0.gguf")
-
-# Few‑shot prompt template embedding:
-#    - Instructions for mapping responses => RIASEC scores
-#    - Mapping tables for the check‑box questions
-#    - One complete worked example
-#    - Final “Now you do it” section with placeholders
-
-template = """
-You are an expert career-counselor bot.  Your task:
-
-1. **Map motivational responses** (6 Likert values) into RIASEC scores:
-   - Intrinsic Motivation => Artistic (A), Investigative (I)
-   - Identified Regulation => Social (S), Investigative (I), Artistic (A)
-   - Integrated Regulation => Social (S), Enterprising (E), Artistic (A)
-   - Introjected Regulation => Enterprising (E), Conventional (C), Realistic (R)
-   - External Regulation => Conventional (C), Realistic (R), Enterprising (E)
-   - Amotivation => (no categories)
-   For each category, **add** the raw Likert value.
-
-2. **Map check-box responses** (each +1 point) to RIASEC:
-   - **Interest Fields**:
-     • Health and medicine => S  
-     • Agriculture and sciences => I  
-     • Arts and communication => A  
-     • Engineering and technology => R, I  
-     • Business and management => E, C  
-     • Human and public service => S  
-   - **Qualities**:
-     Compassionate and caring => S │ Good listener => S │ Following directions => C │ Conscientious => C │ Patient => S │
-     Problem solver => I │ Nature lover => R │ Physically active => R │ Observer => I │ Imaginative => A │ Creative => A │
-     Outgoing => S │ Performer => A │ Hands-on creator => R │ Logical thinker => I │ Practical => R │ Decision-maker => E │
-     Open-minded => A │ Organized => C  
-   - **Free-time Activities**:
-     Volunteering => S │ Caring for others => S │ Healthy living => R │ Hiking => R │ Experimentation => I │
-     Acting => A │ Writing => A │ Painting => A │ Building things => R │ Computing => I │ Coaching/tutoring => S
-
-3. **Sum** all points for each of R, I, A, S, E, C.
-
-4. **Choose top 2 RIASEC letters**. From each, pick majors:
-   R => Mechanical Eng, Civil Eng, Electrical Eng, Architecture, Industrial Design  
-   I => Biology, Chemistry, Computer Science, Mathematics, Data Science  
-   A => Fine Arts, Graphic Design, Journalism, Music, Theater  
-   S => Psychology, Nursing, Education, Social Work, Human Services  
-   E => Business Admin, Marketing, Finance, Entrepreneurship, Management  
-   C => Accounting, Finance, Economics, Library Science, Info Systems  
-
-   Take **3 majors** from the highest-scoring letter and **2** from the second.
-
-5. **Output** as a single paragraph:
-
----  
-### Worked Example
-
-**Student Responses**  
-Interest Fields: Arts and communication, Human and public service  
-Qualities: Compassionate and caring, Creative, Outgoing  
-Free-time Activities: Writing, Acting, Volunteering  
-Motivational Responses:  
-- Intrinsic Motivation: 5  
-- Identified Regulation: 4  
-- Introjected Regulation: 2  
-- Integrated Regulation: 3  
-- Amotivation: 1  
-- External Regulation: 2  
-
-**Computation**  
-- From Likert:  
-A += 5 (Intrinsic) + 4 (Identified) + 3 (Integrated) = 12  
-I += 5 + 4 = 9  
-S += 4 + 3 + 2 = 9  
-E += 2 + 2 = 4  
-C += 2 + 2 = 4  
-R += 2 = 2  
-- From check-boxes:  
-A += 1 (Arts) + 1 (Creative) + 1 (Outgoing) + 1 (Writing) + 1 (Acting) = 5 => A total = 17  
-S += 1 (Human service) + 1 (Compassionate) + 1 (Outgoing) + 1 (Volunteering) = 4 => S total = 13  
-… and so on.  
-
-Final scores (example): A=17, S=13, I=9, E=4, C=4, R=2  
-Top two letters: **A**, **S**  
-Select 3 Artistic majors + 2 Social majors =>  
-Top 5 majors: Fine Arts, Graphic Design, Music, Psychology, Nursing.
-
-**Output Paragraph**:  
-Top 5 majors: Fine Arts, Graphic Design, Music, Psychology, Nursing.  
-This student shows exceptionally strong **Artistic** tendencies. Their creative qualities, like being imaginative and enjoying activities such as acting, writing, and painting, align perfectly with careers in fine arts and design. Their **Social** tendencies, showcased by their compassion and enjoyment of volunteering and helping others, make them well-suited for fields like psychology and nursing, where empathy and communication are key. This combination of creativity and social awareness suggests a fulfilling career path in the arts and human services.
-
----  
-Now, process the actual student responses below and generate the recommendation.
-
-**Student Responses**  
-Interest Fields: {interest_fields}  
-Qualities: {qualities}  
-Free-time Activities: {free_time_activities}  
-Motivational Responses:  
-- Intrinsic Motivation: {intrinsic_motivation}  
-- Identified Regulation: {identified_regulation}  
-- Introjected Regulation: {introjected_regulation}  
-- Integrated Regulation: {integrated_regulation}  
-- Amotivation: {amotivation}  
-- External Regulation: {external_regulation}  
-
-**Return**: one paragraph with “Top 5 majors: …” then a long, insightful explanation.
+MODEL_PATH = os.environ.get("MODEL_PATH", "models/zephyr-7b-beta.Q4_K_M.gguf")
+# Optional 1-3B model (e.g. Qwen2.5-1.5B-Instruct Q4_K_M) for simple answer sets; unset to
+# serve everything with MODEL_PATH. Requests with at most SMALL_MODEL_MAX_CHECKBOXES
+# interest fields + qualities are routed to it.
+SMALL_MODEL_PATH = os.environ.get("SMALL_MODEL_PATH")
+SMALL_MODEL_MAX_CHECKBOXES = int(os.environ.get("SMALL_MODEL_MAX_CHECKBOXES", 6))
+
+# Response cache settings; set REDIS_URL to share the cache between workers/instances
+CACHE_MAX_SIZE = int(os.environ.get("CACHE_MAX_SIZE", 4096))
+CACHE_TTL = int(os.environ.get("CACHE_TTL", 24 * 60 * 60))
+REDIS_URL = os.environ.get("REDIS_URL")
+
+def env_flag(name: str, default: bool) -> bool:
+    return os.environ.get(name, str(default)).lower() in ("1", "true", "yes")
+
+# One CPU id per physical core this process may run on. llama.cpp's matmul kernels already
+# saturate a core's AVX/FMA units with one thread, so SMT siblings only add contention.
+def physical_core_cpus() -> List[int]:
+    allowed = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+    cpus, cores = [], set()
+    for cpu in allowed:
+        try:
+            with open(f"/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list") as f:
+                siblings = f.read().strip()
+        except OSError:
+            return []  # No topology info (non-Linux, some sandboxes)
+        if siblings not in cores:
+            cores.add(siblings)
+            cpus.append(cpu)
+    return cpus
+
+# llama.cpp settings, overridable per deployment
+N_CTX = int(os.environ.get("N_CTX", 1024))        # Prompt only carries the explanation task
+N_BATCH = int(os.environ.get("N_BATCH", 2048))    # Logical batch: the whole prompt is prefilled in one call
+# Layers to offload when running on a GPU instance (33 offloads all of Zephyr-7B)
+N_GPU_LAYERS = int(os.environ.get("N_GPU_LAYERS", 0))
+# Memory-mapped weights live in the page cache, so worker processes on one host share them
+USE_MMAP = env_flag("USE_MMAP", True)
+USE_MLOCK = env_flag("USE_MLOCK", False)
+# One thread per physical core for prompt processing and generation (llama.cpp scales
+# poorly past ~16 threads). Without topology info fall back to psutil, then to half the
+# logical CPUs assuming 2-way SMT.
+CORE_CPUS = physical_core_cpus()[:16]
+N_THREADS = int(os.environ.get("N_THREADS", 0)) or len(CORE_CPUS) or min(
+    psutil.cpu_count(logical=False) or max((os.cpu_count() or 2) // 2, 1), 16
+)
+# Pin the process to CORE_CPUS so the kernel doesn't put two llama.cpp threads on siblings
+PIN_CPUS = env_flag("PIN_CPUS", True)
+
+# Generation settings for the explanation paragraph. Decode time is linear in tokens, so
+# cap it just above a long paragraph and stop as soon as the model starts a new block.
+MAX_TOKENS = 320
+STOP = ["\n\n", "---", "**Student"]
+
+# Requests decoded together per model (continuous batching, see BatchEngine). Each
+# sequence gets N_CTX tokens of KV cache.
+N_PARALLEL = int(os.environ.get("N_PARALLEL", 4))
+# How long an idle model waits for concurrent requests before starting a batch
+BATCH_WINDOW = float(os.environ.get("BATCH_WINDOW_MS", 5)) / 1000
+# Requests waiting for a free sequence beyond this are rejected with 503
+QUEUE_MAX_SIZE = int(os.environ.get("QUEUE_MAX_SIZE", 32))
+
+# RIASEC scoring rubric, applied in Python so the LLM only has to write the explanation
+# Each Likert answer adds its raw value to every letter it maps to
+LIKERT_MAP = {
+    "intrinsic_motivation": "AI",
+    "identified_regulation": "SIA",
+    "integrated_regulation": "SEA",
+    "introjected_regulation": "ECR",
+    "external_regulation": "CRE",
+    "amotivation": "",
+}
+
+# Each ticked check-box (interest field, quality or free-time activity) adds +1 per letter.
+# Ticking the same box twice still counts once.
+CHECKBOX_MAP = {
+    # Interest Fields
+    "Health and medicine": "S",
+    "Agriculture and sciences": "I",
+    "Arts and communication": "A",
+    "Engineering and technology": "RI",
+    "Business and management": "EC",
+    "Human and public service": "S",
+    # Qualities
+    "Compassionate and caring": "S",
+    "Good listener": "S",
+    "Following directions": "C",
+    "Conscientious": "C",
+    "Patient": "S",
+    "Problem solver": "I",
+    "Nature lover": "R",
+    "Physically active": "R",
+    "Observer": "I",
+    "Imaginative": "A",
+    "Creative": "A",
+    "Outgoing": "S",
+    "Performer": "A",
+    "Hands-on creator": "R",
+    "Logical thinker": "I",
+    "Practical": "R",
+    "Decision-maker": "E",
+    "Open-minded": "A",
+    "Organized": "C",
+    # Free-time Activities
+    "Volunteering": "S",
+    "Caring for others": "S",
+    "Healthy living": "R",
+    "Hiking": "R",
+    "Experimentation": "I",
+    "Acting": "A",
+    "Writing": "A",
+    "Painting": "A",
+    "Building things": "R",
+    "Computing": "I",
+    "Coaching/tutoring": "S",
+}
+
+# Bit position of every check-box option, used to pack a request into a cache key
+CHECKBOX_INDEX = {option: bit for bit, option in enumerate(CHECKBOX_MAP)}
+# Interest fields and qualities come before the free-time activities, so their bits are
+# everything below the first activity; these decide which model answers (see pick_engine)
+ROUTING_MASK = (1 << CHECKBOX_INDEX["Volunteering"]) - 1
+
+# 3 majors are taken from the highest-scoring letter and 2 from the second
+MAJORS_BY_LETTER = {
+    "R": ["Mechanical Eng", "Civil Eng", "Electrical Eng", "Architecture", "Industrial Design"],
+    "I": ["Biology", "Chemistry", "Computer Science", "Mathematics", "Data Science"],
+    "A": ["Fine Arts", "Graphic Design", "Journalism", "Music", "Theater"],
+    "S": ["Psychology", "Nursing", "Education", "Social Work", "Human Services"],
+    "E": ["Business Admin", "Marketing", "Finance", "Entrepreneurship", "Management"],
+    "C": ["Accounting", "Finance", "Economics", "Library Science", "Info Systems"],
+}
+
+RIASEC_NAMES = {
+    "R": "Realistic",
+    "I": "Investigative",
+    "A": "Artistic",
+    "S": "Social",
+    "E": "Enterprising",
+    "C": "Conventional",
+}
+
+# Prompt for the only step that needs the LLM: the explanation paragraph.
+# PREFIX is identical on every request and comes first, so llama.cpp keeps its KV cache
+# between requests and only prefills SUFFIX (see BatchEngine).
+PREFIX = """
+You are an expert career-counselor bot. You will be given a student's RIASEC scores, their two strongest tendencies and their top 5 recommended majors.
+Write one long, insightful paragraph explaining why these majors suit the student, linking their two strongest tendencies to the careers these majors lead to.
+Do not repeat the list of majors at the start of the paragraph.
 Make sure to not use asterisks in your reply
 Make sure to personalize it to them (use the pronoun "you", rather than referring to them as "This student")
+
 """
 
-# Function for adding the variables (student responses) to the prompt template
-prompt = PromptTemplate(
-    input_variables=[
-        "interest_fields",
-        "qualities",
-        "free_time_activities",
-        "intrinsic_motivation",
-        "identified_regulation",
-        "introjected_regulation",
-        "integrated_regulation",
-        "amotivation",
-        "external_regulation"
-    ],
-    template=template
-)
+SUFFIX = """RIASEC scores: {scores_summary}
+Strongest tendency: {primary_letter}
+Second strongest tendency: {secondary_letter}
+Top 5 majors: {majors}
 
-# Initialize the LLM with CPU-only configuration
-llm = LlamaCpp(
-    model_path=MODEL_PATH,
-    n_ctx=4096,
-    temperature=0.0,
-    n_gpu_layers=0,  # Set to 0 for CPU-only
-    n_batch=512,     # Adjusted batch size for CPU processing
-    use_mmap=True,   # Enable memory mapping for faster model loading
-    use_mlock=False  # Disable memory locking since we're using mmap
-)
-chain = LLMChain(llm=llm, prompt=prompt)
+Explanation:
+"""
+
+template = PREFIX + SUFFIX
+
+# Load the weights and tokenizer. Decoding runs in BatchEngine's own multi-sequence
+# context, so the Llama object's context is kept minimal.
+def load_llm(model_path: str) -> Llama:
+    return Llama(
+        model_path=model_path,
+        n_ctx=32,
+        n_batch=32,
+        n_gpu_layers=N_GPU_LAYERS,
+        use_mmap=USE_MMAP,
+        use_mlock=USE_MLOCK,
+    )
+
+# The KV cache is allocated up front, N_CTX tokens per sequence (~128 KB per token for
+# Zephyr-7B with the default f16 cache), so N_CTX is kept just above the largest prompt
+# plus its generation budget.
+# Checked at startup against a worst-case rendering of the template.
+def check_context_budget(llm: Llama):
+    longest_name = max(RIASEC_NAMES.values(), key=len)
+    worst_case = template.format(
+        scores_summary=", ".join(f"{longest_name} ({k}) = 99" for k in RIASEC_NAMES),
+        primary_letter=f"{longest_name} (I)",
+        secondary_letter=f"{longest_name} (I)",
+        majors=", ".join(sorted((m for ms in MAJORS_BY_LETTER.values() for m in ms), key=len)[-5:]),
+    )
+    prompt_tokens = len(llm.tokenize(worst_case.encode("utf-8")))
+    budget = prompt_tokens + MAX_TOKENS
+    if budget > N_CTX:
+        raise RuntimeError(f"N_CTX={N_CTX} is too small: prompt needs up to {prompt_tokens} tokens plus {MAX_TOKENS} to generate")
+    logger.info("Context budget: %d prompt + %d generated of N_CTX=%d", prompt_tokens, MAX_TOKENS, N_CTX)
+
+# Only one forward pass runs at a time across all engines, so the small and large model
+# take turns on the CPU rather than competing for it
+decode_lock = asyncio.Lock()
+
+# Sequence 0 holds PREFIX; requests are decoded in sequences 1..N_PARALLEL
+PREFIX_SEQ = 0
+
+# A request being decoded in one of the engine's sequences
+class Slot:
+    def __init__(self, seq_id: int, prompt_tokens: List[int], n_past: int, tokens: asyncio.Queue, cancelled: threading.Event):
+        self.seq_id = seq_id
+        self.pending = prompt_tokens  # Prompt tokens not evaluated yet
+        self.n_past = n_past          # Position of the next token in the sequence
+        self.tokens = tokens
+        self.cancelled = cancelled
+        self.last_token = None        # Sampled token to feed on the next step
+        self.logits_index = -1        # Batch index whose logits belong to this slot
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        self.text = ""
+        self.sent = 0
+        self.completion_tokens = 0
+
+# Continuous batching: up to N_PARALLEL requests share one llama.cpp context, each in its
+# own sequence, and every forward pass advances all of them by one token. Decode on CPU is
+# bound by streaming the weights from memory, so a pass for 4 sequences costs little more
+# than a pass for 1. New requests join between passes as soon as a sequence frees up.
+# PREFIX is evaluated once into PREFIX_SEQ and its KV cells are shared with every request
+# via llama_kv_cache_seq_cp, so only the per-request SUFFIX is prefilled.
+# Sampling is greedy (temperature 0) and done in Python on the returned logits.
+class BatchEngine:
+    def __init__(self, llm: Llama):
+        self.llm = llm
+        self.name = os.path.basename(llm.model_path)
+        params = llama_cpp.llama_context_default_params()
+        params.n_ctx = N_CTX * N_PARALLEL
+        params.n_batch = N_BATCH
+        params.n_ubatch = 512        # Physical batch per forward pass
+        params.n_seq_max = N_PARALLEL + 1
+        params.n_threads = N_THREADS
+        params.n_threads_batch = N_THREADS
+        params.flash_attn = True
+        params.defrag_thold = 0.1    # Compact the KV cache as finished sequences leave holes
+        self.ctx = llama_cpp.llama_init_from_model(llm.model, params)
+        if self.ctx is None:
+            raise RuntimeError(f"Failed to create llama.cpp context for {self.name}")
+        self.batch = llama_cpp.llama_batch_init(N_BATCH, 0, 1)
+        self.vocab = llama_cpp.llama_model_get_vocab(llm.model)
+        self.n_vocab = llm.n_vocab()
+        self.prefix_tokens = []
+        self.slots = {}
+        self.queue = asyncio.Queue(maxsize=QUEUE_MAX_SIZE)
+        # Held for the duration of llama_decode, which runs in a worker thread and keeps
+        # going after run() is cancelled; close() takes it before freeing the context
+        self.decoding = threading.Lock()
+        self.worker = None
+
+    # Evaluate PREFIX into PREFIX_SEQ before accepting traffic. The first forward pass
+    # faults the memory-mapped weights into RAM (10-30 s for a 7B model), which would
+    # otherwise land on the first user.
+    def warm_up(self):
+        started = time.perf_counter()
+        tokens = self.llm.tokenize(PREFIX.encode("utf-8"))
+        for start in range(0, len(tokens), N_BATCH):
+            self.batch.n_tokens = 0
+            for pos, token in enumerate(tokens[start:start + N_BATCH], start):
+                # Request logits for the last token so the output layer is paged in too
+                self._add(token, pos, PREFIX_SEQ, pos == len(tokens) - 1)
+            self._decode()
+        self.prefix_tokens = tokens
+        logger.info("Warmed up %s in %.1fs (%d prefix tokens)", self.name, time.perf_counter() - started, len(tokens))
+
+    def _add(self, token: int, pos: int, seq_id: int, logits: bool) -> int:
+        batch, i = self.batch, self.batch.n_tokens
+        batch.token[i] = token
+        batch.pos[i] = pos
+        batch.n_seq_id[i] = 1
+        batch.seq_id[i][0] = seq_id
+        batch.logits[i] = logits
+        batch.n_tokens += 1
+        return i
+
+    def _decode(self):
+        with self.decoding:
+            status = llama_cpp.llama_decode(self.ctx, self.batch)
+        if status != 0:
+            raise RuntimeError(f"llama_decode failed with status {status}")
+
+    def start(self):
+        self.worker = asyncio.create_task(self.run())
+        self.worker.add_done_callback(self._stopped)
 
-app = FastAPI()
+    # run() only returns when cancelled at shutdown; anything else leaves queued requests
+    # hanging, so log it (/health reports the engine as down from here on)
+    def _stopped(self, worker: asyncio.Task):
+        if not worker.cancelled():
+            logger.error("Batch loop for %s stopped", self.name, exc_info=worker.exception())
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # The request being admitted, which has no slot yet if admitting it fails
+            job = None
+            try:
+                if not self.slots:
+                    # Idle: wait for a request, then give concurrent ones a moment to join it
+                    job = await self.queue.get()
+                    self._admit(*job)
+                    job = None
+                    await asyncio.sleep(BATCH_WINDOW)
+                while len(self.slots) < N_PARALLEL and not self.queue.empty():
+                    job = self.queue.get_nowait()
+                    self._admit(*job)
+                    job = None
+                if not self._fill_batch():
+                    continue
+                async with decode_lock:
+                    await loop.run_in_executor(None, self._decode)
+                self._sample()
+            except Exception as exc:
+                # Fail the requests in flight and keep serving the queue
+                logger.exception("Batch step failed on %s", self.name)
+                if job is not None:
+                    job[1].put_nowait(exc)
+                    job[1].put_nowait(None)
+                for slot in list(self.slots.values()):
+                    try:
+                        self._finish(slot, "error", exc)
+                    except Exception:
+                        logger.exception("Could not free sequence %d on %s", slot.seq_id, self.name)
+
+    # Called at shutdown once run() has been cancelled
+    def close(self):
+        with self.decoding:
+            llama_cpp.llama_batch_free(self.batch)
+            llama_cpp.llama_free(self.ctx)
+            self.ctx = None
+
+    def _admit(self, prompt: str, tokens: asyncio.Queue, cancelled: threading.Event):
+        # Skip requests whose client already went away
+        if cancelled.is_set():
+            tokens.put_nowait(None)
+            return
+        seq_id = next(i for i in range(1, N_PARALLEL + 1) if i not in self.slots)
+        prompt_tokens = self.llm.tokenize(prompt.encode("utf-8"))
+        # Share the KV cells of the common prefix, keeping at least one token to evaluate
+        n_shared = 0
+        for a, b in zip(self.prefix_tokens, prompt_tokens[:-1]):
+            if a != b:
+                break
+            n_shared += 1
+        llama_cpp.llama_kv_cache_seq_cp(self.ctx, PREFIX_SEQ, seq_id, 0, n_shared)
+        self.slots[seq_id] = Slot(seq_id, prompt_tokens[n_shared:], n_shared, tokens, cancelled)
+
+    # Build the next batch: one token for every generating slot, then prompt tokens of
+    # newly admitted slots with whatever room is left. Returns False if there is nothing to do.
+    def _fill_batch(self) -> bool:
+        self.batch.n_tokens = 0
+        for slot in list(self.slots.values()):
+            if slot.cancelled.is_set():
+                self._finish(slot, "cancelled")
+            elif slot.last_token is not None:
+                slot.logits_index = self._add(slot.last_token, slot.n_past, slot.seq_id, True)
+                slot.n_past += 1
+        for slot in self.slots.values():
+            room = N_BATCH - self.batch.n_tokens
+            if not slot.pending or room == 0:
+                continue
+            chunk, slot.pending = slot.pending[:room], slot.pending[room:]
+            for token in chunk:
+                index = self._add(token, slot.n_past, slot.seq_id, False)
+                slot.n_past += 1
+            if not slot.pending:
+                self.batch.logits[index] = True
+                slot.logits_index = index
+        return self.batch.n_tokens > 0
+
+    def _sample(self):
+        for slot in list(self.slots.values()):
+            if slot.logits_index < 0:
+                continue
+            logits = np.ctypeslib.as_array(llama_cpp.llama_get_logits_ith(self.ctx, slot.logits_index), shape=(self.n_vocab,))
+            slot.logits_index = -1
+            token = int(np.argmax(logits))
+            if llama_cpp.llama_vocab_is_eog(self.vocab, token):
+                self._flush(slot, len(slot.text))
+                self._finish(slot, "stop")
+                continue
+            slot.last_token = token
+            slot.completion_tokens += 1
+            slot.text += slot.decoder.decode(self.llm.detokenize([token]))
+
+            # Stop sequences only apply once the paragraph has started, so a leading blank
+            # line doesn't end generation with no text. Any stop starts after the text
+            # already sent, see below.
+            body = len(slot.text) - len(slot.text.lstrip())
+            stops = []
+            if body < len(slot.text):
+                stops = [i for i in (slot.text.find(s, max(slot.sent, body)) for s in STOP) if i >= 0]
+            if stops:
+                self._flush(slot, min(stops))
+                self._finish(slot, "stop")
+            elif slot.completion_tokens >= MAX_TOKENS or slot.n_past >= N_CTX:
+                self._flush(slot, len(slot.text))
+                self._finish(slot, "length")
+            else:
+                # Hold back a tail that could still turn into a stop sequence
+                held = max((k for s in STOP for k in range(1, len(s)) if slot.text.endswith(s[:k])), default=0)
+                self._flush(slot, len(slot.text) - held)
+
+    def _flush(self, slot: Slot, end: int):
+        if end > slot.sent:
+            slot.tokens.put_nowait(slot.text[slot.sent:end])
+            slot.sent = end
+
+    def _finish(self, slot: Slot, finish_reason: str, exc: Optional[Exception] = None):
+        # Release the client before touching llama.cpp, which may be what failed
+        del self.slots[slot.seq_id]
+        if exc is not None:
+            slot.tokens.put_nowait(exc)
+        slot.tokens.put_nowait(None)
+        logger.info("completion_tokens=%d finish_reason=%s model=%s", slot.completion_tokens, finish_reason, self.name)
+        llama_cpp.llama_kv_cache_seq_rm(self.ctx, slot.seq_id, -1, -1)
+
+# Loaded engines by name ("large", and "small" when SMALL_MODEL_PATH is set)
+engines = {}
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if PIN_CPUS and CORE_CPUS:
+        try:
+            os.sched_setaffinity(0, CORE_CPUS)
+            logger.info("Pinned to CPUs %s", CORE_CPUS)
+        except OSError as exc:
+            logger.warning("Could not pin to CPUs %s: %s", CORE_CPUS, exc)
+    # Shows which SIMD extensions llama.cpp was built with (e.g. AVX512_VNNI = 1)
+    logger.info("llama.cpp system info: %s", llama_cpp.llama_print_system_info().decode("utf-8").strip())
+    # The model is loaded once per worker process at startup, not as an import side effect
+    loop = asyncio.get_running_loop()
+    paths = {"large": MODEL_PATH}
+    if SMALL_MODEL_PATH:
+        paths["small"] = SMALL_MODEL_PATH
+    for name, path in paths.items():
+        llm = await loop.run_in_executor(None, load_llm, path)
+        check_context_budget(llm)
+        engine = BatchEngine(llm)
+        await loop.run_in_executor(None, engine.warm_up)
+        engines[name] = engine
+    for engine in engines.values():
+        engine.start()
+    yield
+    for engine in engines.values():
+        engine.worker.cancel()
+    await asyncio.gather(*(engine.worker for engine in engines.values()), return_exceptions=True)
+    for engine in engines.values():
+        # Waits for a forward pass still running in the executor
+        await loop.run_in_executor(None, engine.close)
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # Request model based on how the answers will come, and in this order
 class RIASECRequest(BaseModel):
     interest_fields: List[str]
     qualities: List[str]
     free_time_activities: List[str]
-    intrinsic_motivation: int
-    identified_regulation: int
-    introjected_regulation: int
-    integrated_regulation: int
-    amotivation: int
-    external_regulation: int
+    # Likert answers on a 1-5 scale
+    intrinsic_motivation: int = Field(ge=1, le=5)
+    identified_regulation: int = Field(ge=1, le=5)
+    introjected_regulation: int = Field(ge=1, le=5)
+    integrated_regulation: int = Field(ge=1, le=5)
+    amotivation: int = Field(ge=1, le=5)
+    external_regulation: int = Field(ge=1, le=5)
+
+# Generation is deterministic (temperature=0), so identical answers always produce the
+# same recommendation. Same lookup/update interface as langchain-core's BaseCache:
+# an in-process LRU in front of an optional Redis tier.
+# Cache keys are (check-box bitmask, packed Likert answers), see cache_key
+CacheKey = Tuple[int, int]
+
+class ResponseCache:
+    def __init__(self, maxsize: int, redis_url: Optional[str] = None, ttl: int = CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        self._redis = None
+        if redis_url:
+            # Short timeouts: an unreachable Redis must degrade to the local LRU, not stall requests
+            self._redis = redis.Redis.from_url(redis_url, socket_timeout=0.5, socket_connect_timeout=0.5)
+
+    # Redis calls run in a worker thread so a slow round-trip doesn't stall the event loop,
+    # which also drives every BatchEngine
+    async def lookup(self, key: CacheKey) -> Optional[str]:
+        with self._lock:
+            if key in self._local:
+                self._local.move_to_end(key)
+                return self._local[key]
+        if self._redis is not None:
+            try:
+                value = await asyncio.to_thread(self._redis.get, self._redis_key(key))
+            except redis.RedisError as exc:
+                logger.warning("Redis lookup failed, using local cache only: %s", exc)
+                return None
+            if value is not None:
+                value = value.decode("utf-8")
+                self._store_local(key, value)
+                return value
+        return None
+
+    async def update(self, key: CacheKey, value: str) -> None:
+        self._store_local(key, value)
+        if self._redis is not None:
+            try:
+                await asyncio.to_thread(self._redis.setex, self._redis_key(key), self.ttl, value)
+            except redis.RedisError as exc:
+                logger.warning("Redis update failed, cached locally only: %s", exc)
+
+    @staticmethod
+    def _redis_key(key: CacheKey) -> str:
+        return "recommendation:%x:%x" % key
+
+    def _store_local(self, key: CacheKey, value: str) -> None:
+        with self._lock:
+            self._local[key] = value
+            self._local.move_to_end(key)
+            if len(self._local) > self.maxsize:
+                self._local.popitem(last=False)
+
+cache = ResponseCache(CACHE_MAX_SIZE, REDIS_URL)
+
+# Canonical signature of a request, packed into two ints: one bit per ticked check-box
+# (order, duplicates and unknown options don't affect the answer) and 3 bits per Likert answer
+def cache_key(req: RIASECRequest) -> CacheKey:
+    mask = 0
+    for option in req.interest_fields + req.qualities + req.free_time_activities:
+        bit = CHECKBOX_INDEX.get(option)
+        if bit is not None:
+            mask |= 1 << bit
+    likert = 0
+    for field in LIKERT_MAP:
+        likert = (likert << 3) | getattr(req, field)
+    return mask, likert
+
+def compute_scores(req: RIASECRequest) -> dict:
+    scores = {letter: 0 for letter in "RIASEC"}
+
+    # Check-box answers: +1 per mapped letter
+    for option in set(req.interest_fields + req.qualities + req.free_time_activities):
+        for letter in CHECKBOX_MAP.get(option, ""):
+            scores[letter] += 1
+
+    # Likert answers: add the raw value to each mapped letter
+    for field, letters in LIKERT_MAP.items():
+        for letter in letters:
+            scores[letter] += getattr(req, field)
+
+    return scores
+
+def pick_majors(primary: str, secondary: str) -> List[str]:
+    majors = MAJORS_BY_LETTER[primary][:3]
+    # E and C share "Finance", so skip anything already picked
+    majors += [m for m in MAJORS_BY_LETTER[secondary] if m not in majors][:2]
+    return majors
+
+# Few ticked boxes give the explanation little to work with, so a small model writes it
+# just as well at a fraction of the per-token cost
+# Routes on the cache key rather than the raw lists, so duplicate or unknown options can't
+# send two requests sharing a cached answer to different models
+def pick_engine(key: CacheKey) -> BatchEngine:
+    if "small" in engines and bin(key[0] & ROUTING_MASK).count("1") <= SMALL_MODEL_MAX_CHECKBOXES:
+        return engines["small"]
+    return engines["large"]
+
+# Hands the rendered prompt to a model engine; returns the request's token queue
+# (terminated by None, preceded by an exception if generation failed) and the event
+# used to abandon generation
+def submit(engine: BatchEngine, prompt: str):
+    tokens, cancelled = asyncio.Queue(), threading.Event()
+    try:
+        engine.queue.put_nowait((prompt, tokens, cancelled))
+    except asyncio.QueueFull:
+        raise HTTPException(status_code=503, detail="Too many pending requests, please retry shortly")
+    return tokens, cancelled
+
+# Server-Sent Events frame; the payload is JSON-encoded so newlines survive
+def sse(data: str) -> str:
+    return f"data: {orjson.dumps(data).decode()}\n\n"
+
+async def stream_cached(recommendation: str) -> AsyncIterator[str]:
+    yield sse(recommendation)
+    yield "data: [DONE]\n\n"
+
+async def stream_generation(key: CacheKey, header: str, tokens: asyncio.Queue, cancelled: threading.Event) -> AsyncIterator[str]:
+    parts = [header]
+    try:
+        yield sse(header)
+        while (chunk := await tokens.get()) is not None:
+            if isinstance(chunk, Exception):
+                yield "event: error\ndata: \"Generation failed\"\n\n"
+                return
+            # Drop the whitespace the model emits before the paragraph
+            if len(parts) == 1:
+                chunk = chunk.lstrip()
+                if not chunk:
+                    continue
+            parts.append(chunk)
+            yield sse(chunk)
+        # Only cache a complete recommendation, never the bare header
+        if len(parts) > 1:
+            await cache.update(key, "".join(parts).rstrip())
+        yield "data: [DONE]\n\n"
+    finally:
+        cancelled.set()
+
+# uvicorn only starts serving once the lifespan (model load + warm-up) has finished, so
+# answering here means the instance is ready; point readiness/startup probes at it
+@app.get("/health")
+async def health():
+    down = [name for name, engine in engines.items() if engine.worker is None or engine.worker.done()]
+    if down:
+        raise HTTPException(status_code=503, detail=f"Model engine down: {', '.join(down)}")
+    return {"status": "ok"}
 
 @app.post("/recommend")
-def recommend(req: RIASECRequest):
-    answers = req.model_dump()
+async def recommend(req: RIASECRequest):
+    key = cache_key(req)
+    recommendation = await cache.lookup(key)
+    if recommendation is not None:
+        return StreamingResponse(stream_cached(recommendation), media_type="text/event-stream", headers={"X-Cache": "HIT"})
 
-    # Converting lists to strings for the prompt
-    answers["interest_fields"] = ", ".join(answers["interest_fields"])
-    answers["qualities"] = ", ".join(answers["qualities"])
-    answers["free_time_activities"] = ", ".join(answers["free_time_activities"])
+    scores = compute_scores(req)
+    primary, secondary = sorted(scores, key=scores.get, reverse=True)[:2]
+    majors = pick_majors(primary, secondary)
 
-    out = chain.run(answers)
-    return {"recommendation": out}
\ No newline at end of file
+    tokens, cancelled = submit(pick_engine(key), template.format(
+        scores_summary=", ".join(f"{RIASEC_NAMES[k]} ({k}) = {v}" for k, v in scores.items()),
+        primary_letter=f"{RIASEC_NAMES[primary]} ({primary})",
+        secondary_letter=f"{RIASEC_NAMES[secondary]} ({secondary})",
+        majors=", ".join(majors),
+    ))
+    header = f"Top 5 majors: {', '.join(majors)}.\n"
+    return StreamingResponse(stream_generation(key, header, tokens, cancelled), media_type="text/event-stream", headers={"X-Cache": "MISS"})